@@ -1,14 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
 from scipy import signal as sg
+from scipy import ndimage
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+try:
+    import cupy as cp
+    from cupyx.scipy import signal as cusg
+    from cupyx.scipy import ndimage as cundimage
+except ImportError:
+    cp = None
 # взял отсюда https://github.com/antimattercorrade/Pan_Tompkins_QRS_Detection/blob/main/Pan_Tompkins.ipynb
 
+# Low pass filter coefficients:
+#   H(z) = (1 - 2z^-6 + z^-12) / (1 - 2z^-1 + z^-2)
+_LOW_PASS_B = np.zeros(13)
+_LOW_PASS_B[[0, 6, 12]] = 1, -2, 1
+_LOW_PASS_A = np.array([1, -2, 1])
+
+# High pass filter coefficients:
+#   H(z) = (-1 + 32z^-16 + z^-32) / (1 + z^-1)
+_HIGH_PASS_B = np.zeros(33)
+_HIGH_PASS_B[[0, 16, 32]] = -1, 32, 1
+_HIGH_PASS_A = np.array([1, 1])
+
+
+def _get_backend(backend):
+    '''
+    Array, signal and ndimage modules used for filtering
+    :param backend: 'cpu' for numpy/scipy or 'cuda' for cupy
+    :return: (array module, signal module, ndimage module)
+    '''
+    if backend == 'cpu':
+        return np, sg, ndimage
+    if backend == 'cuda':
+        if cp is None:
+            raise ImportError("backend='cuda' requires cupy to be installed")
+        return cp, cusg, cundimage
+    raise ValueError(f"unknown backend {backend!r}, expected 'cpu' or 'cuda'")
+
 
 class Pan_Tompkins_QRS():
 
-    def __init__(self, freq):
+    def __init__(self, freq, backend='cpu'):
+        '''
+        :param freq: sample frequency of input signal
+        :param backend: 'cpu' to filter with numpy/scipy,
+                        'cuda' to filter on the GPU with cupy
+        '''
         self.freq = freq
+        self.xp, self.sg, self.ndimage = _get_backend(backend)
+
+        # Band pass filter coefficients on the selected device
+        self.low_pass_b, self.low_pass_a = self.xp.asarray(
+            _LOW_PASS_B), self.xp.asarray(_LOW_PASS_A)
+        self.high_pass_b, self.high_pass_a = self.xp.asarray(
+            _HIGH_PASS_B), self.xp.asarray(_HIGH_PASS_A)
+
+        # Derivative filter kernel, reversed since convolve1d flips it
+        self.derivative_kernel = self.xp.asarray(
+            np.array([1, 2, 0, -2, -1]) * (self.freq / 8))
 
     def band_pass_filter(self, signal):
         '''
@@ -30,47 +83,18 @@ class Pan_Tompkins_QRS():
           y(nT) = 32x(nT - 16T) - y(nT - T) - x(nT) + x(nT - 32T)
         '''
 
-        # Initialize result
-        result = None
-
-        # Create a copy of the input signal
-        sig = signal.copy()
-
-        # Apply the low pass filter using the equation given
-        for index in range(len(signal)):
-            sig[index] = signal[index]
-
-            if (index >= 1):
-                sig[index] += 2*sig[index-1]
-
-            if (index >= 2):
-                sig[index] -= sig[index-2]
-
-            if (index >= 6):
-                sig[index] -= 2*signal[index-6]
-
-            if (index >= 12):
-                sig[index] += signal[index-12]
-
-        # Copy the result of the low pass filter
-        result = sig.copy()
-
-        # Apply the high pass filter using the equation given
-        for index in range(len(signal)):
-            result[index] = -1*sig[index]
-
-            if (index >= 1):
-                result[index] -= result[index-1]
-
-            if (index >= 16):
-                result[index] += 32*sig[index-16]
-
-            if (index >= 32):
-                result[index] += sig[index-32]
+        # Apply the low pass and then the high pass filter. The low pass
+        # filter has a double pole at z = 1, so it is always evaluated in
+        # float64 to keep rounding errors from accumulating
+        xp = self.xp
+        sig = self.sg.lfilter(self.low_pass_b, self.low_pass_a, xp.asarray(
+            signal, dtype=xp.float64), axis=-1)
+        result = self.sg.lfilter(self.high_pass_b, self.high_pass_a,
+                                 sig, axis=-1).astype(signal.dtype)
 
         # Normalize the result from the high pass filter
-        max_val = max(max(result), -min(result))
-        result = result/max_val
+        max_val = xp.abs(result).max(axis=-1, keepdims=True)
+        xp.divide(result, max_val, out=result)
 
         return result
 
@@ -89,26 +113,15 @@ class Pan_Tompkins_QRS():
           y(nT) = [-x(nT - 2T) - 2x(nT - T) + 2x(nT + T) + x(nT + 2T)]/(8T)
         '''
 
-        # Initialize result
-        result = signal.copy()
-
-        # Apply the derivative filter using the equation given
-        for index in range(len(signal)):
-            result[index] = 0
-
-            if (index >= 1):
-                result[index] -= 2*signal[index-1]
+        # Apply the derivative filter as a 5-tap convolution
+        kernel = self.derivative_kernel.astype(signal.dtype, copy=False)
+        result = self.ndimage.convolve1d(
+            signal, kernel, axis=-1, mode='constant')
 
-            if (index >= 2):
-                result[index] -= signal[index-2]
-
-            if (index >= 2 and index <= len(signal)-2):
-                result[index] += 2*signal[index+1]
-
-            if (index >= 2 and index <= len(signal)-3):
-                result[index] += signal[index+2]
-
-            result[index] = (result[index]*self.freq)/8
+        # Forward terms are only used starting from the third sample
+        result[..., 0] = 0
+        if (signal.shape[-1] >= 2):
+            result[..., 1] = -2*signal[..., 0]*self.freq/8
 
         return result
 
@@ -128,14 +141,8 @@ class Pan_Tompkins_QRS():
           y(nT) = [x(nT)]^2
         '''
 
-        # Initialize result
-        result = signal.copy()
-
         # Apply the squaring using the equation given
-        for index in range(len(signal)):
-            result[index] = signal[index]**2
-
-        return result
+        return self.xp.square(signal)
 
     def moving_window_integration(self, signal):
         '''
@@ -156,28 +163,25 @@ class Pan_Tompkins_QRS():
           window.
         '''
 
-        # Initialize result and window size for integration
-        result = signal.copy()
+        # Initialize window size for integration
         win_size = round(0.150 * self.freq)
-        sum = 0
 
-        # Calculate the sum for the first N terms
-        for j in range(win_size):
-            sum += signal[j]/win_size
-            result[j] = sum
+        # Running sum of the signal, accumulated in float64 to avoid drift
+        cumsum = self.xp.cumsum(signal, axis=-1, dtype=self.xp.float64)
 
-        # Apply the moving window integration using the equation given
-        for index in range(win_size, len(signal)):
-            sum += signal[index]/win_size
-            sum -= signal[index-win_size]/win_size
-            result[index] = sum
+        # Average over the first N terms and then over a sliding window
+        result = self.xp.empty_like(cumsum)
+        result[..., :win_size] = cumsum[..., :win_size] / win_size
+        result[..., win_size:] = (
+            cumsum[..., win_size:] - cumsum[..., :-win_size]) / win_size
 
-        return result
+        return result.astype(signal.dtype)
 
     def solve(self, signal):
         '''
         Solver, Combines all the above functions
-        :param signal: input signal
+        :param signal: input signal, either a single lead of shape (N,)
+                       or several leads of shape (C, N)
         :return: prcoessed signal
 
         Methodology/Explaination:
@@ -186,22 +190,28 @@ class Pan_Tompkins_QRS():
         output of the bandpass filter is given to the derivative function and
         the result is squared. Finally the output of the squaring function
         is given to the moving window integration function and returned. 
+        All the filters are applied along the last axis, so the leads of a
+        multichannel record are processed together.
         '''
 
-        # Convert the input signal into numpy array
-        input_signal = signal
+        # Convert the input signal into float32 numpy array,
+        # all the stages below preserve its dtype
+        input_signal = self.xp.asarray(signal, dtype=self.xp.float32)
+
+        # Every stage returns a new array and leaves its input untouched,
+        # so no defensive copies are needed between the stages
 
         # Bandpass Filter
-        bpass = self.band_pass_filter(input_signal.copy())
+        bpass = self.band_pass_filter(input_signal)
 
         # Derivative Function
-        der = self.derivative(bpass.copy())
+        der = self.derivative(bpass)
 
         # Squaring Function
-        sqr = self.squaring(der.copy())
+        sqr = self.squaring(der)
 
         # Moving Window Integration Function
-        mwin = self.moving_window_integration(sqr.copy())
+        mwin = self.moving_window_integration(sqr)
 
         return {'bpass': bpass, 'der': der, 'sqr': sqr, 'mwin': mwin}
 
@@ -221,7 +231,6 @@ class R_peak_extractor():
         self.SPKI, self.NPKI, self.Threshold_I1, self.Threshold_I2, self.SPKF, self.NPKF, self.Threshold_F1, self.Threshold_F2 = (
             0 for i in range(8))
 
-        self.T_wave = False
         self.m_win = qrs_dict['mwin']
         self.b_pass = qrs_dict['bpass']
         self.samp_freq = samp_freq
@@ -232,20 +241,27 @@ class R_peak_extractor():
         self.RR_High_Limit = 0
         self.RR_Missed_Limit = 0
         self.RR_Average1 = 0
+        self.RR_intervals = np.array([])
+
+        # Number of used entries in probable_peaks, r_locs and result,
+        # which are preallocated once the approximate peaks are known
+        self.n_probable_peaks = self.n_r_locs = self.n_result = 0
 
     def approx_peak(self):
         '''
         Approximate peak locations
         '''
 
-        # FFT convolution
-        slopes = sg.fftconvolve(
-            self.m_win, np.full((25,), 1) / 25, mode='same')
+        # Centered 25 sample moving average computed from a running sum,
+        # equivalent to convolving with np.full((25,), 1) / 25 in 'same' mode
+        padded = np.pad(np.asarray(self.m_win, dtype=np.float64), 12)
+        cumsum = np.concatenate(([0], np.cumsum(padded)))
+        slopes = (cumsum[25:] - cumsum[:-25]) / 25
 
         # Finding approximate peak locations
-        for i in range(round(0.5*self.samp_freq) + 1, len(slopes)-1):
-            if (slopes[i] > slopes[i-1]) and (slopes[i+1] < slopes[i]):
-                self.peaks.append(i)
+        peaks, _ = sg.find_peaks(slopes)
+        peaks = peaks[peaks > round(0.5*self.samp_freq)]
+        self.peaks = peaks.tolist()
 
     def adjust_rr_interval(self, ind):
         '''
@@ -254,10 +270,13 @@ class R_peak_extractor():
         '''
 
         # Finding the eight most recent RR intervals
-        self.RR1 = np.diff(self.peaks[max(0, ind - 8): ind + 1])/self.samp_freq
+        start = max(0, ind - 8)
+        self.RR1 = self.RR_intervals[start: ind]
 
-        # Calculating RR Averages
-        self.RR_Average1 = np.mean(self.RR1)
+        # Calculating RR Averages, the RR intervals sum up to
+        # the distance between the first and the last peak
+        self.RR_Average1 = (self.peaks[ind] - self.peaks[start]) / \
+            ((ind - start) * self.samp_freq)
         RR_Average2 = self.RR_Average1
 
         # Finding the eight most recent RR intervals lying between RR Low Limit and RR High Limit
@@ -276,77 +295,80 @@ class R_peak_extractor():
             self.RR_High_Limit = 1.16 * RR_Average2
             self.RR_Missed_Limit = 1.66 * RR_Average2
 
-    def searchback(self, peak_val, RRn, sb_win):
+    def searchback(self, peak_val, RRn, sb_win, thresholds):
         '''
         Searchback
         :param peak_val: peak location in consideration
         :param RRn: the most recent RR interval
         :param sb_win: searchback window
+        :param thresholds: current signal/noise levels and thresholds
+        :return: updated signal/noise levels and thresholds
         '''
 
+        SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2 = thresholds
+
         # Check if the most recent RR interval is greater than the RR Missed Limit
         if (RRn > self.RR_Missed_Limit):
             # Initialize a window to searchback
             win_rr = self.m_win[peak_val - sb_win + 1: peak_val + 1]
 
-            # Find the x locations inside the window having y values greater than Threshold I1
-            coord = np.asarray(win_rr > self.Threshold_I1).nonzero()[0]
-
-            # Find the x location of the max peak value in the search window
-            if (len(coord) > 0):
-                for pos in coord:
-                    if (win_rr[pos] == max(win_rr[coord])):
-                        x_max = pos
-                        break
-            else:
-                x_max = None
+            # Find the x location of the max peak value in the search window,
+            # it is only taken if the peak is greater than Threshold I1
+            x_max = None
+            if (len(win_rr) > 0):
+                x_max = int(np.argmax(win_rr))
+                if (win_rr[x_max] <= Threshold_I1):
+                    x_max = None
 
             # If the max peak value is found
             if (x_max is not None):
                 # Update the thresholds corresponding to moving window integration
-                self.SPKI = 0.25 * self.m_win[x_max] + 0.75 * self.SPKI
-                self.Threshold_I1 = self.NPKI + 0.25 * (self.SPKI - self.NPKI)
-                self.Threshold_I2 = 0.5 * self.Threshold_I1
+                SPKI = 0.25 * self.m_win[x_max] + 0.75 * SPKI
+                Threshold_I1 = NPKI + 0.25 * (SPKI - NPKI)
+                Threshold_I2 = 0.5 * Threshold_I1
 
                 # Initialize a window to searchback
                 win_rr = self.b_pass[x_max -
                                      self.win_150ms: min(len(self.b_pass) - 1, x_max)]
 
-                # Find the x locations inside the window having y values greater than Threshold F1
-                coord = np.asarray(win_rr > self.Threshold_F1).nonzero()[0]
-
-                # Find the x location of the max peak value in the search window
-                if (len(coord) > 0):
-                    for pos in coord:
-                        if (win_rr[pos] == max(win_rr[coord])):
-                            r_max = pos
-                            break
-                else:
-                    r_max = None
+                # Find the x location of the max peak value in the search window,
+                # it is only taken if the peak is greater than Threshold F1
+                r_max = None
+                if (len(win_rr) > 0):
+                    r_max = int(np.argmax(win_rr))
+                    if (win_rr[r_max] <= Threshold_F1):
+                        r_max = None
 
                 # If the max peak value is found
                 if (r_max is not None):
                     # Update the thresholds corresponding to bandpass filter
-                    if self.b_pass[r_max] > self.Threshold_F2:
-                        self.SPKF = 0.25 * \
-                            self.b_pass[r_max] + 0.75 * self.SPKF
-                        self.Threshold_F1 = self.NPKF + \
-                            0.25 * (self.SPKF - self.NPKF)
-                        self.Threshold_F2 = 0.5 * self.Threshold_F1
+                    if self.b_pass[r_max] > Threshold_F2:
+                        SPKF = 0.25 * self.b_pass[r_max] + 0.75 * SPKF
+                        Threshold_F1 = NPKF + 0.25 * (SPKF - NPKF)
+                        Threshold_F2 = 0.5 * Threshold_F1
 
                         # Append the probable R peak location
-                        self.r_locs.append(r_max)
+                        self.r_locs[self.n_r_locs] = r_max
+                        self.n_r_locs += 1
 
-    def find_t_wave(self, peak_val, RRn, ind, prev_ind):
+        return SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2
+
+    def find_t_wave(self, peak_val, RRn, ind, prev_ind, thresholds):
         '''
         T Wave Identification
         :param peak_val: peak location in consideration
         :param RRn: the most recent RR interval
         :param ind: current index in peaks array
         :param prev_ind: previous index in peaks array
+        :param thresholds: current signal/noise levels and thresholds
+        :return: updated signal/noise levels and thresholds
         '''
 
-        if (self.m_win[peak_val] >= self.Threshold_I1):
+        SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2 = thresholds
+        m_win_peak = self.m_win[peak_val]
+        T_wave = False
+
+        if (m_win_peak >= Threshold_I1):
             if (ind > 0 and 0.20 < RRn < 0.36):
                 # Find the slope of current and last waveform detected
                 curr_slope = max(
@@ -357,66 +379,79 @@ class R_peak_extractor():
                 # If current waveform slope is less than half of last waveform slope
                 if (curr_slope < 0.5*last_slope):
                     # T Wave is found and update noise threshold
-                    self.T_wave = True
-                    self.NPKI = 0.125 * \
-                        self.m_win[peak_val] + 0.875 * self.NPKI
+                    T_wave = True
+                    NPKI = 0.125 * m_win_peak + 0.875 * NPKI
 
-            if (not self.T_wave):
+            if (not T_wave):
                 # T Wave is not found and update signal thresholds
-                if (self.probable_peaks[ind] > self.Threshold_F1):
-                    self.SPKI = 0.125 * \
-                        self.m_win[peak_val] + 0.875 * self.SPKI
-                    self.SPKF = 0.125 * self.b_pass[ind] + 0.875 * self.SPKF
+                if (self.probable_peaks[ind] > Threshold_F1):
+                    SPKI = 0.125 * m_win_peak + 0.875 * SPKI
+                    SPKF = 0.125 * self.b_pass[ind] + 0.875 * SPKF
 
                     # Append the probable R peak location
-                    self.r_locs.append(self.probable_peaks[ind])
+                    self.r_locs[self.n_r_locs] = self.probable_peaks[ind]
+                    self.n_r_locs += 1
 
                 else:
-                    self.SPKI = 0.125 * \
-                        self.m_win[peak_val] + 0.875 * self.SPKI
-                    self.NPKF = 0.125 * self.b_pass[ind] + 0.875 * self.NPKF
+                    SPKI = 0.125 * m_win_peak + 0.875 * SPKI
+                    NPKF = 0.125 * self.b_pass[ind] + 0.875 * NPKF
 
         # Update noise thresholds
-        elif (self.m_win[peak_val] < self.Threshold_I1) or (self.Threshold_I1 < self.m_win[peak_val] < self.Threshold_I2):
-            self.NPKI = 0.125 * self.m_win[peak_val] + 0.875 * self.NPKI
-            self.NPKF = 0.125 * self.b_pass[ind] + 0.875 * self.NPKF
+        elif (m_win_peak < Threshold_I1) or (Threshold_I1 < m_win_peak < Threshold_I2):
+            NPKI = 0.125 * m_win_peak + 0.875 * NPKI
+            NPKF = 0.125 * self.b_pass[ind] + 0.875 * NPKF
+
+        return SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2
 
-    def adjust_thresholds(self, peak_val, ind):
+    def adjust_thresholds(self, peak_val, ind, thresholds):
         '''
         Adjust Noise and Signal Thresholds During Learning Phase
         :param peak_val: peak location in consideration
         :param ind: current index in peaks array
+        :param thresholds: current signal/noise levels and thresholds
+        :return: updated signal/noise levels and thresholds
         '''
 
-        if (self.m_win[peak_val] >= self.Threshold_I1):
+        SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2 = thresholds
+        m_win_peak = self.m_win[peak_val]
+
+        if (m_win_peak >= Threshold_I1):
             # Update signal threshold
-            self.SPKI = 0.125 * self.m_win[peak_val] + 0.875 * self.SPKI
+            SPKI = 0.125 * m_win_peak + 0.875 * SPKI
 
-            if (self.probable_peaks[ind] > self.Threshold_F1):
-                self.SPKF = 0.125 * self.b_pass[ind] + 0.875 * self.SPKF
+            if (self.probable_peaks[ind] > Threshold_F1):
+                SPKF = 0.125 * self.b_pass[ind] + 0.875 * SPKF
 
                 # Append the probable R peak location
-                self.r_locs.append(self.probable_peaks[ind])
+                self.r_locs[self.n_r_locs] = self.probable_peaks[ind]
+                self.n_r_locs += 1
 
             else:
                 # Update noise threshold
-                self.NPKF = 0.125 * self.b_pass[ind] + 0.875 * self.NPKF
+                NPKF = 0.125 * self.b_pass[ind] + 0.875 * NPKF
 
         # Update noise thresholds
-        elif (self.m_win[peak_val] < self.Threshold_I2) or (self.Threshold_I2 < self.m_win[peak_val] < self.Threshold_I1):
-            self.NPKI = 0.125 * self.m_win[peak_val] + 0.875 * self.NPKI
-            self.NPKF = 0.125 * self.b_pass[ind] + 0.875 * self.NPKF
+        elif (m_win_peak < Threshold_I2) or (Threshold_I2 < m_win_peak < Threshold_I1):
+            NPKI = 0.125 * m_win_peak + 0.875 * NPKI
+            NPKF = 0.125 * self.b_pass[ind] + 0.875 * NPKF
+
+        return SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2
 
-    def update_thresholds(self):
+    def update_thresholds(self, thresholds):
         '''
         Update Noise and Signal Thresholds for next iteration
+        :param thresholds: current signal/noise levels and thresholds
+        :return: updated signal/noise levels and thresholds
         '''
 
-        self.Threshold_I1 = self.NPKI + 0.25 * (self.SPKI - self.NPKI)
-        self.Threshold_F1 = self.NPKF + 0.25 * (self.SPKF - self.NPKF)
-        self.Threshold_I2 = 0.5 * self.Threshold_I1
-        self.Threshold_F2 = 0.5 * self.Threshold_F1
-        self.T_wave = False
+        SPKI, NPKI, _, _, SPKF, NPKF, _, _ = thresholds
+
+        Threshold_I1 = NPKI + 0.25 * (SPKI - NPKI)
+        Threshold_F1 = NPKF + 0.25 * (SPKF - NPKF)
+        Threshold_I2 = 0.5 * Threshold_I1
+        Threshold_F2 = 0.5 * Threshold_F1
+
+        return SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2
 
     def ecg_searchback(self):
         '''
@@ -424,27 +459,24 @@ class R_peak_extractor():
         '''
 
         # Filter the unique R peak locations
-        self.r_locs = np.unique(np.array(self.r_locs).astype(int))
+        self.r_locs = np.unique(self.r_locs[:self.n_r_locs])
+        self.n_r_locs = len(self.r_locs)
+        self.result = np.empty(self.n_r_locs, dtype=np.int64)
 
         # Initialize a window to searchback
         win_200ms = round(0.2*self.samp_freq)
 
         for r_val in self.r_locs:
-            coord = np.arange(r_val - win_200ms,
-                              min(len(self.signal), r_val + win_200ms + 1), 1)
+            win_start = max(0, r_val - win_200ms)
+            win_end = min(len(self.signal), r_val + win_200ms + 1)
 
-            # Find the x location of the max peak value
-            if (len(coord) > 0):
-                for pos in coord:
-                    if (self.signal[pos] == max(self.signal[coord])):
-                        x_max = pos
-                        break
-            else:
-                x_max = None
+            # Find the x location of the max peak value and append it
+            if (win_end > win_start):
+                self.result[self.n_result] = win_start + \
+                    np.argmax(self.signal[win_start: win_end])
+                self.n_result += 1
 
-            # Append the peak location
-            if (x_max is not None):
-                self.result.append(x_max)
+        self.result = self.result[:self.n_result]
 
     def find_r_peaks(self):
         '''
@@ -454,43 +486,62 @@ class R_peak_extractor():
         # Find approximate peak locations
         self.approx_peak()
 
+        # RR intervals between consecutive approximate peaks
+        self.RR_intervals = np.diff(self.peaks) / self.samp_freq
+
+        # Every peak adds at most one probable peak and two R peak locations
+        self.probable_peaks = np.empty(len(self.peaks), dtype=np.int64)
+        self.r_locs = np.empty(2 * len(self.peaks), dtype=np.int64)
+
+        # Signal/noise levels and thresholds are kept in a local tuple
+        # while iterating and written back to the instance at the end
+        thresholds = (self.SPKI, self.NPKI, self.Threshold_I1, self.Threshold_I2,
+                      self.SPKF, self.NPKF, self.Threshold_F1, self.Threshold_F2)
+
         # Iterate over possible peak locations
         for ind in range(len(self.peaks)):
 
             # Initialize the search window for peak detection
             peak_val = self.peaks[ind]
-            win_300ms = np.arange(max(0, self.peaks[ind] - self.win_150ms), min(
-                self.peaks[ind] + self.win_150ms, len(self.b_pass)-1), 1)
-            max_val = max(self.b_pass[win_300ms], default=0)
+            win_start = max(0, self.peaks[ind] - self.win_150ms)
+            win_300ms = self.b_pass[win_start: min(
+                self.peaks[ind] + self.win_150ms, len(self.b_pass)-1)]
 
             # Find the x location of the max peak value
-            if (max_val != 0):
-                x_coord = np.asarray(self.b_pass == max_val).nonzero()
-                self.probable_peaks.append(x_coord[0][0])
+            if (len(win_300ms) > 0):
+                self.probable_peaks[self.n_probable_peaks] = win_start + \
+                    np.argmax(win_300ms)
+                self.n_probable_peaks += 1
 
-            if (ind < len(self.probable_peaks) and ind != 0):
+            if (ind < self.n_probable_peaks and ind != 0):
                 # Adjust RR interval and limits
                 self.adjust_rr_interval(ind)
 
                 # Adjust thresholds in case of irregular beats
                 if (self.RR_Average1 < self.RR_Low_Limit or self.RR_Average1 > self.RR_Missed_Limit):
-                    self.Threshold_I1 /= 2
-                    self.Threshold_F1 /= 2
+                    SPKI, NPKI, Threshold_I1, Threshold_I2, SPKF, NPKF, Threshold_F1, Threshold_F2 = thresholds
+                    thresholds = (SPKI, NPKI, Threshold_I1 / 2, Threshold_I2,
+                                  SPKF, NPKF, Threshold_F1 / 2, Threshold_F2)
 
                 RRn = self.RR1[-1]
 
                 # Searchback
-                self.searchback(peak_val, RRn, round(RRn*self.samp_freq))
+                thresholds = self.searchback(
+                    peak_val, RRn, round(RRn*self.samp_freq), thresholds)
 
                 # T Wave Identification
-                self.find_t_wave(peak_val, RRn, ind, ind-1)
+                thresholds = self.find_t_wave(
+                    peak_val, RRn, ind, ind-1, thresholds)
 
             else:
                 # Adjust threholds
-                self.adjust_thresholds(peak_val, ind)
+                thresholds = self.adjust_thresholds(peak_val, ind, thresholds)
 
             # Update threholds for next iteration
-            self.update_thresholds()
+            thresholds = self.update_thresholds(thresholds)
+
+        (self.SPKI, self.NPKI, self.Threshold_I1, self.Threshold_I2,
+         self.SPKF, self.NPKF, self.Threshold_F1, self.Threshold_F2) = thresholds
 
         # Searchback in ECG signal
         self.ecg_searchback()
@@ -498,22 +549,64 @@ class R_peak_extractor():
         return self.result
 
 
-def extract_beats(denoised_record, freq, n_seconds4beat=1, test=False):
+def _process_lead(signal, qrs_dict, freq, left_bound, right_bound):
+    '''
+    R peak detection and beat extraction for a single ECG lead
+    :param signal: denoised signal of the lead
+    :param qrs_dict: output of Pan_Tompkins_QRS.solve for the lead
+    :param freq: sample frequency of input signal
+    :param left_bound: number of samples taken before the R peak
+    :param right_bound: number of samples taken after the R peak
+    :return: beats, R peak locations, heart rate, second difference of R peaks
+    '''
+    beat_extractor = R_peak_extractor(signal, freq, qrs_dict)
+
+    result = np.array(beat_extractor.find_r_peaks())
+    result = result[result > 0]
+    # remove first r_peak, as it's often mispredicted
+    result = result[1:]
+
+    # extract beats from extracted r peaks, that are within boundaries
+    valid = (result-left_bound >= 0) & (result+right_bound < len(signal))
+    beat_idx = result[valid, None] + np.arange(-left_bound, right_bound)
+    curr_beats = signal[beat_idx]
+    rr_intervals = np.diff(result)
+    max_dif = np.diff(rr_intervals)
+    heartRate = (60*freq)/rr_intervals.mean()
+    return curr_beats, result, heartRate, max_dif
+
+
+def extract_beats(denoised_record, freq, n_seconds4beat=1, test=False, n_jobs=1, backend='cpu'):
+    '''
+    n_jobs - number of worker processes used for the 12 leads,
+             1 processes the leads sequentially, None uses all available cores
+    backend - 'cpu' or 'cuda', device used for the filtering stages,
+              R peak detection always runs on the CPU
+    '''
+    denoised_record = np.asarray(denoised_record, dtype=np.float32)[:12]
     results = []
     left_bound = int(n_seconds4beat*freq*1/4)
     right_bound = int(n_seconds4beat*freq*3/4)
-    heart_rates = []
-    max_diffs = []
-    for i in range(12):
-        QRS_detector = Pan_Tompkins_QRS(freq)
-        qrs_dict = QRS_detector.solve(denoised_record[i])
-        beat_extractor = R_peak_extractor(denoised_record[i], freq, qrs_dict)
-
-        result = np.array(beat_extractor.find_r_peaks())
-        result = result[result > 0]
-        # remove first r_peak, as it's often mispredicted
-        result = result[1:]
 
+    # filter all the leads at once, only peak detection is done per lead
+    QRS_detector = Pan_Tompkins_QRS(freq, backend)
+    qrs_dict = QRS_detector.solve(denoised_record)
+    if backend == 'cuda':
+        qrs_dict = {key: cp.asnumpy(value) for key, value in qrs_dict.items()}
+    leads = [denoised_record[i] for i in range(12)]
+    qrs_dicts = [{key: value[i] for key, value in qrs_dict.items()}
+                 for i in range(12)]
+
+    if n_jobs == 1:
+        processed = [_process_lead(lead, lead_qrs_dict, freq, left_bound, right_bound)
+                     for lead, lead_qrs_dict in zip(leads, qrs_dicts)]
+    else:
+        max_workers = min(12, n_jobs or os.cpu_count())
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            processed = list(executor.map(_process_lead, leads, qrs_dicts, repeat(freq),
+                                          repeat(left_bound), repeat(right_bound)))
+
+    for i, (curr_beats, result, _, _) in enumerate(processed):
         # show extracted r_peaks
         if test and i == 0:
             plt.figure(figsize=(16, 8), dpi=100)
@@ -522,18 +615,5 @@ def extract_beats(denoised_record, freq, n_seconds4beat=1, test=False):
             plt.scatter(
                 result, denoised_record[i][result], color='red', s=50, marker='*')
 
-        # extract beats from extracted r peaks
-        curr_beats = []
-        for r_peak in result:
-            # check boundaries
-            if r_peak+right_bound >= len(denoised_record[i]) or r_peak-left_bound < 0:
-                continue
-            beat = denoised_record[i][r_peak-left_bound: r_peak+right_bound]
-            curr_beats.append(np.asarray(beat))
-        results.append(np.asarray(curr_beats))
-        #max_dif = np.diff(np.diff(result))
-        max_dif = np.diff(np.diff(result))
-        max_diffs.append(max_dif)
-        heartRate = (60*freq)/np.average(np.diff(result))
-        heart_rates.append(heartRate)
+        results.append(curr_beats)
     return results